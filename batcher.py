@@ -0,0 +1,102 @@
+"""
+This file defines a dynamic batcher for AI query classification.
+
+Queries that arrive within a short window of each other are classified together, with a
+single model call, instead of making one call per query.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+class DynamicBatcher:
+    """
+    Collects concurrent requests into batches of up to `max_batch_size` items, waiting at most
+    `max_delay` seconds after the first request of a batch, and passes each batch to `process_batch`.
+
+    `process_batch` receives the list of inputs and must return one result (or exception) per input, in order.
+    """
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_batch_size: int = 8,
+        max_delay: float = 0.05
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: set = set() # In-flight batches
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        """
+        Start collecting batches (must be called from a running event loop).
+        """
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect_batches(), name="dynamic-batcher")
+
+    async def stop(self):
+        """
+        Stop collecting batches and wait for in-flight batches to complete.
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Add `item` to the next batch and wait for its result.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect_batches(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+
+            # Keep adding items until the batch is full or the delay has passed
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._run_batch(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _run_batch(self, batch: List[Tuple[Any, asyncio.Future]]):
+        items = [item for item, _ in batch]
+        logging.debug("Processing batch of %s items", len(items))
+        try:
+            results = await self.process_batch(items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
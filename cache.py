@@ -0,0 +1,197 @@
+"""
+This file defines a local, watch-based cache of Kubernetes resources.
+
+Similar to a client-go SharedInformer, each `ResourceCache` lists a resource type once,
+then keeps an in-process copy up to date from a long-lived watch connection. Handlers
+can then answer queries from memory instead of re-listing resources on every request.
+
+Objects are read as raw JSON (skipping the client's model deserialization), and only the
+few fields the handlers need are kept, since every worker process holds its own copy.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Optional, Tuple
+from kubernetes_asyncio import client, watch
+import clients
+from helpers import LIST_PAGE_SIZE, list_page_raw
+
+# Server-side timeout for each watch request (the watch is then resumed)
+WATCH_TIMEOUT = 300
+# A cache is considered stale if it hasn't been synced for this long (in seconds)
+MAX_STALENESS = WATCH_TIMEOUT + 60
+# Delay before retrying after a failed list/watch (in seconds)
+RETRY_DELAY = 5
+
+class ResourceCache:
+    """
+    Keeps an in-process copy of one Kubernetes resource type, keyed by `(namespace, name)`.
+    Cluster-scoped resources (e.g., nodes, namespaces) use an empty namespace.
+
+    Each (raw JSON) object is cached as `transform(obj)`; without a `transform`, only its key is kept.
+    """
+    def __init__(self, kind: str, transform: Optional[Callable[[Dict[str, Any]], Any]] = None):
+        self.kind = kind
+        self.transform = transform # Optional function that extracts the fields to cache from each object
+        self.items: Dict[Tuple[str, str], Any] = {}
+        self.namespace_counts: Dict[str, int] = {} # Number of cached objects per namespace
+        self.synced = False # True once the initial list has completed
+        self.last_event_at = 0.0 # Monotonic time of the last list, event or watch renewal
+        self._list_func: Optional[Callable] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def is_fresh(self) -> bool:
+        """
+        Return whether the cache can be used to answer queries.
+        """
+        return self.synced and time.monotonic() - self.last_event_at < MAX_STALENESS
+
+    def start(self, list_func: Callable):
+        """
+        Start the background list/watch loop using the given (cluster-wide) list function.
+        """
+        self._list_func = list_func
+        self._task = asyncio.create_task(self._watch_loop(), name=f"watch-{self.kind}")
+
+    async def stop(self):
+        """
+        Cancel the background watch loop and drop the cached objects.
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.items.clear()
+        self.namespace_counts.clear()
+        self.synced = False
+
+    async def _relist(self) -> str:
+        """
+        Replace the cached objects with a fresh (paginated, raw) list, returning its resource version.
+        """
+        items = {}
+        continue_token = None
+        while True:
+            data = await list_page_raw(self._list_func, LIST_PAGE_SIZE, continue_token)
+            for obj in data['items']:
+                items[_key(obj)] = self._cached_value(obj)
+            continue_token = data['metadata'].get('continue')
+            if not continue_token:
+                break
+        self.items = items
+        self.namespace_counts = Counter(namespace for namespace, _ in self.items)
+        self.synced = True
+        self.last_event_at = time.monotonic()
+        logging.debug("Listed %s %s", len(self.items), self.kind)
+        return data['metadata']['resourceVersion']
+
+    async def _watch_loop(self):
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = await self._relist()
+
+                # (return_type="object": events are passed on as plain dicts instead of models)
+                async with watch.Watch(return_type="object") as w:
+                    stream = w.stream(
+                        self._list_func,
+                        resource_version=resource_version,
+                        timeout_seconds=WATCH_TIMEOUT,
+                        allow_watch_bookmarks=True
+                    )
+                    async for event in stream:
+                        if event['type'] != 'BOOKMARK':
+                            self._apply(event['type'], event['object'])
+                        resource_version = w.resource_version
+                        self.last_event_at = time.monotonic()
+
+                # Watch timed out normally; resume from the last seen resource version
+                self.last_event_at = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except client.rest.ApiException as e:
+                if e.status == 410:
+                    # Resource version too old ("Gone"): start over with a fresh list
+                    logging.debug("Watch for %s expired, relisting", self.kind)
+                else:
+                    logging.error("Kubernetes API error while watching %s: %s", self.kind, e)
+                    await asyncio.sleep(RETRY_DELAY)
+                resource_version = None
+            except Exception as e:
+                logging.error("Error while watching %s: %s", self.kind, e)
+                resource_version = None
+                await asyncio.sleep(RETRY_DELAY)
+
+    def _apply(self, event_type: str, obj: Dict[str, Any]):
+        key = _key(obj)
+        namespace = key[0]
+        if event_type == 'DELETED':
+            if key in self.items:
+                del self.items[key]
+                self.namespace_counts[namespace] -= 1
+        else: # ADDED, MODIFIED
+            if key not in self.items:
+                self.namespace_counts[namespace] = self.namespace_counts.get(namespace, 0) + 1
+            self.items[key] = self._cached_value(obj)
+
+    def _cached_value(self, obj: Dict[str, Any]) -> Any:
+        return self.transform(obj) if self.transform else None
+
+def _key(obj: Dict[str, Any]) -> Tuple[str, str]:
+    metadata = obj['metadata']
+    return (metadata.get('namespace') or "", metadata['name'])
+
+def pod_labels(pod: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Return a (raw) pod's labels, the only pod field the handlers need.
+    """
+    return pod['metadata'].get('labels') or {}
+
+def label_selector(match_labels: Dict[str, str]) -> str:
+    """
+    Build a label selector string from `match_labels` (sorted, so equal selectors compare equal).
+    """
+    return ','.join(sorted(f"{k}={v}" for k, v in match_labels.items()))
+
+def deployment_selector(deployment: Dict[str, Any]) -> Tuple[Dict[str, str], str]:
+    """
+    Return a (raw) deployment's selector, as `(match_labels, label selector string)`.
+    """
+    match_labels = deployment['spec']['selector'].get('matchLabels') or {}
+    return (match_labels, label_selector(match_labels))
+
+# Resource caches, shared by all query handlers
+# (nodes, services and namespaces are only counted or listed by name, so only their keys are kept)
+pod_cache = ResourceCache("pods", transform=pod_labels)
+node_cache = ResourceCache("nodes")
+service_cache = ResourceCache("services")
+namespace_cache = ResourceCache("namespaces")
+deployment_cache = ResourceCache("deployments", transform=deployment_selector)
+
+def start_caches():
+    """
+    Start watching all cached resource types (requires initialized Kubernetes clients).
+    """
+    pod_cache.start(clients.core_v1_api.list_pod_for_all_namespaces)
+    node_cache.start(clients.core_v1_api.list_node)
+    service_cache.start(clients.core_v1_api.list_service_for_all_namespaces)
+    namespace_cache.start(clients.core_v1_api.list_namespace)
+    deployment_cache.start(clients.apps_v1_api.list_deployment_for_all_namespaces)
+
+async def stop_caches():
+    """
+    Stop all resource watches.
+    """
+    await asyncio.gather(
+        pod_cache.stop(),
+        node_cache.stop(),
+        service_cache.stop(),
+        namespace_cache.stop(),
+        deployment_cache.stop()
+    )
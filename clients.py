@@ -2,37 +2,134 @@
 This file sets up the necessary API (Kubernetes, OpenAI) clients.
 """
 
+import asyncio
 import os
 import logging
-from kubernetes import client, config
-from openai import OpenAI
+import time
+import httpx
+import redis.asyncio as redis
+from kubernetes_asyncio import client, config
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 # Load API key for OpenAI model usage
 load_dotenv()
 
-# Initialize Kubernetes API clients at module level
-try:
-    config.load_kube_config()
-    core_v1_api = client.CoreV1Api()
-    apps_v1_api = client.AppsV1Api()
-    
-    # Test connection
-    core_v1_api.list_node()
-    logging.debug("Successfully initialized Kubernetes clients")
-except Exception as e:
-    logging.error(f"Failed to initialize Kubernetes clients: {e}")
-    core_v1_api = None
-    apps_v1_api = None
+# Maximum number of concurrent connections to the Kubernetes API server
+# (shared by all Kubernetes API clients, including the long-lived watches of the resource caches)
+K8S_CONNECTION_POOL_MAXSIZE = int(os.getenv('K8S_CONNECTION_POOL_MAXSIZE', 64))
+
+# Kubernetes API clients (initialized on application startup, see `init_clients`)
+api_client = None
+core_v1_api = None
+apps_v1_api = None
 
 # Initialize OpenAI client at module level
+# (a single async client, reusing HTTP/2 connections across requests)
 try:
-    openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    openai_client = AsyncOpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=httpx.Timeout(30.0, connect=5.0) # Fail fast if OpenAI can't be reached
+        )
+    )
     logging.debug("Successfully initialized OpenAI client")
 except Exception as e:
-    logging.error(f"Failed to initialize OpenAI client: {e}")
+    logging.error("Failed to initialize OpenAI client: %s", e)
     openai_client = None
 
+# Initialize Redis client (response and classification caches) at module level, if REDIS_URL is set
+# (connections are opened lazily, on first use; short timeouts keep an unreachable Redis from delaying queries)
+redis_client = redis.from_url(
+    os.environ['REDIS_URL'],
+    decode_responses=True,
+    socket_connect_timeout=0.5,
+    socket_timeout=0.5
+) if os.getenv('REDIS_URL') else None
+
+# After a Redis error, Redis is skipped for this many seconds (instead of failing, and logging, on every query)
+REDIS_RETRY_INTERVAL = 30
+_redis_retry_at = 0.0
+
+def redis_available() -> bool:
+    """
+    Return whether Redis is configured and has not failed in the last `REDIS_RETRY_INTERVAL` seconds.
+    """
+    return redis_client is not None and time.monotonic() >= _redis_retry_at
+
+def redis_failed(e: Exception):
+    """
+    Skip Redis for the next `REDIS_RETRY_INTERVAL` seconds after the error `e` (logged once).
+    """
+    global _redis_retry_at
+    now = time.monotonic()
+    if now >= _redis_retry_at: # Not already skipped (e.g., by a concurrent query)
+        logging.error("Redis unavailable, skipping it for %s seconds: %s", REDIS_RETRY_INTERVAL, e)
+    _redis_retry_at = now + REDIS_RETRY_INTERVAL
+
+async def init_clients():
+    """
+    Load the kubeconfig and initialize the (async) Kubernetes API clients.
+    Both APIs share a single `ApiClient` (and connection pool), which is closed by `close_clients`.
+    """
+    global api_client, core_v1_api, apps_v1_api
+    try:
+        await config.load_kube_config()
+
+        # Size the shared connection pool explicitly (keep-alive connections are reused across queries)
+        configuration = client.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = K8S_CONNECTION_POOL_MAXSIZE
+        client.Configuration.set_default(configuration)
+        api_client = client.ApiClient(configuration)
+        core_v1_api = client.CoreV1Api(api_client)
+        apps_v1_api = client.AppsV1Api(api_client)
+
+        # Test connection
+        await core_v1_api.list_node()
+        logging.debug("Successfully initialized Kubernetes clients")
+    except Exception as e:
+        logging.error("Failed to initialize Kubernetes clients: %s", e)
+        await close_kubernetes_clients()
+
+async def close_kubernetes_clients():
+    """
+    Close the shared Kubernetes `ApiClient` (and its HTTP session).
+    """
+    global api_client, core_v1_api, apps_v1_api
+    if api_client:
+        await api_client.close()
+    api_client = None
+    core_v1_api = None
+    apps_v1_api = None
+
+async def close_clients():
+    """
+    Close the Kubernetes API clients, the OpenAI client and the Redis connection pool.
+    """
+    await close_kubernetes_clients()
+    if openai_client:
+        await openai_client.close()
+    if redis_client:
+        await redis_client.aclose()
+
+async def warm_up_clients():
+    """
+    Open connections to the Kubernetes API server and OpenAI before serving requests,
+    so the first queries don't pay for new TCP/TLS connections. Failures are only logged.
+    """
+    warm_up_calls = {
+        "Kubernetes (core/v1)": core_v1_api.list_namespace(limit=1),
+        "Kubernetes (apps/v1)": apps_v1_api.list_deployment_for_all_namespaces(limit=1),
+        "OpenAI": openai_client.models.list(),
+    }
+    results = await asyncio.gather(*warm_up_calls.values(), return_exceptions=True)
+    for name, result in zip(warm_up_calls, results):
+        if isinstance(result, Exception):
+            logging.error("Failed to warm up %s connection: %s", name, result)
+    logging.debug("Client connections warmed up")
+
 def verify_clients():
     """
     Verify that both OpenAI and Kubernetes clients are properly initialized.
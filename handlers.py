@@ -2,42 +2,149 @@
 This file defines the query handlers for interacting with Kubernetes resources.
 """
 
-from typing import Protocol, Dict, Any
+from typing import Protocol, Dict, Any, Awaitable, Callable, Tuple
+import asyncio
+import functools
 import logging
-from clients import core_v1_api, apps_v1_api
-from helpers import simplify_name
+import time
+from types import MappingProxyType
+from cachetools import LRUCache, TTLCache
+from kubernetes_asyncio import client
+from redis.exceptions import RedisError
+import clients
+from cache import ResourceCache, pod_cache, node_cache, service_cache, namespace_cache, deployment_cache, label_selector
+from helpers import simplify_name, raise_for_status, list_items_raw, count_items_raw
 
 # TODO: add more error logging here?
 
 # Protocol for query handlers
 class QueryHandler(Protocol):
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         pass
 
+# Response cache policies (seconds before a cached response is considered stale)
+CACHE_TTLS = {
+    "short": 10, # Volatile resources (e.g., pods, logs)
+    "normal": 30,
+    "long": 60, # Rarely changing resources (e.g., nodes, namespaces)
+}
+# How long stale responses are kept as a fallback for Kubernetes API errors
+STALE_BUFFER = 300
+# Deployment label selectors fetched from the API, keyed by (namespace, deployment name)
+# (selectors rarely change, so a short TTL is enough to pick up edits)
+_selector_cache = TTLCache(maxsize=512, ttl=30)
+# Last known selectors (never expire), used to speculatively list pods while a deployment is re-read
+_last_selectors = LRUCache(maxsize=512)
+
+# Maximum size of the pod logs returned by a query (in bytes)
+MAX_LOG_BYTES = 64 * 1024
+
+# In-process cache for responses of handlers that opt into it (e.g., counts), used when the handler's
+# watch caches aren't fresh (a few seconds of staleness is fine, and repeated queries skip Redis
+# and the Kubernetes API, even if Redis isn't configured)
+_local_cache = TTLCache(maxsize=256, ttl=5)
+
+# Redis-backed response cache for query handlers:
+def cached(policy: str = "normal", watch_caches: Tuple[ResourceCache, ...] = (), local: bool = False):
+    """
+    Cache the decorated `handle` method's response in Redis, keyed by handler and parameters.
+    If all of the handler's `watch_caches` are fresh, the handler answers from memory (with
+    real-time data) and the caches are skipped entirely. With `local=True`, responses are
+    also kept in `_local_cache` for a few seconds.
+
+    Fresh entries are returned without calling the Kubernetes API. Stale entries are kept
+    for `STALE_BUFFER` more seconds and returned if the Kubernetes API call fails.
+    If Redis is not configured or unavailable, the handler is called directly.
+    """
+    ttl = CACHE_TTLS[policy]
+
+    def decorator(handle):
+        @functools.wraps(handle)
+        async def wrapper(self, parameters: Dict[str, Any]) -> str:
+            if watch_caches and all(cache.is_fresh() for cache in watch_caches):
+                return await handle(self, parameters)
+
+            key = f"{type(self).__name__}:{sorted(parameters.items())}"
+            if local:
+                result = _local_cache.get(key)
+                if result is not None:
+                    return result
+
+            if clients.redis_available():
+                result = await _redis_cached(key, ttl, lambda: handle(self, parameters))
+            else:
+                result = await handle(self, parameters)
+            if local:
+                _local_cache[key] = result
+            return result
+        return wrapper
+    return decorator
+
+async def _redis_cached(key: str, ttl: int, get_response: Callable[[], Awaitable[str]]) -> str:
+    """
+    Return the fresh Redis entry for `key`, or get the response (with `get_response`) and store it for `ttl` seconds.
+    """
+    entry = {}
+    try:
+        entry = await clients.redis_client.hgetall(key)
+    except RedisError as e:
+        clients.redis_failed(e)
+
+    now = time.time()
+    if entry and float(entry['stale_at']) > now:
+        return entry['body']
+
+    try:
+        result = await get_response()
+    except client.rest.ApiException as e:
+        # Fall back to the last known (stale) response, unless the resource is gone
+        if entry and e.status != 404:
+            logging.error("Kubernetes API error, serving stale response for %s: %s", key, e)
+            return entry['body']
+        raise
+
+    if not clients.redis_available():
+        return result
+    try:
+        async with clients.redis_client.pipeline() as pipe:
+            pipe.hset(key, mapping={"body": result, "generated_at": now, "stale_at": now + ttl})
+            pipe.expire(key, ttl + STALE_BUFFER)
+            await pipe.execute()
+    except RedisError as e:
+        clients.redis_failed(e)
+    return result
+
 # Query handler implementations:
+# (handlers are stateless, so they declare empty `__slots__` to avoid a per-instance `__dict__`)
 class CountPodsHandler:
     """
     Handles queries that involve counting the number of pods in a given namespace.
     If no namespace is provided, it defaults to the 'default' namespace.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="short", watch_caches=(pod_cache,), local=True)
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         namespace = parameters.get('namespace', 'default')
-        # Fetch pods in the namespace
-        pods = core_v1_api.list_namespaced_pod(namespace=namespace)
-        return str(len(pods.items))
+        # Count pods from the local watch cache, if it is up to date
+        if pod_cache.is_fresh():
+            return str(pod_cache.namespace_counts.get(namespace, 0))
+        # Count pods in the namespace (without fetching them)
+        return str(await count_items_raw(clients.core_v1_api.list_namespaced_pod, namespace=namespace))
 
 class PodStatusHandler:
     """
     Handles queries that request the status of a specific pod.
     Requires `pod_name` to be provided. If no namespace is provided, it defaults to 'default'.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="short")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         pod_name = parameters.get('pod_name') # Pod name must be specified
         if not pod_name:
             raise ValueError("Pod name required")
         namespace = parameters.get('namespace', 'default')
         # Fetch the pod details
-        pod = core_v1_api.read_namespaced_pod(pod_name, namespace)
+        pod = await clients.core_v1_api.read_namespaced_pod(pod_name, namespace)
         # Return the pod's current status (e.g., Running, Pending)
         return pod.status.phase
 
@@ -45,32 +152,78 @@ class CountNodesHandler:
     """
     Handles queries that count the number of nodes in the Kubernetes cluster.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
-        # Fetch all nodes in the cluster
-        nodes = core_v1_api.list_node()
-        # Return the count of nodes
-        return str(len(nodes.items))
+    __slots__ = ()
+    @cached(policy="long", watch_caches=(node_cache,), local=True)
+    async def handle(self, parameters: Dict[str, Any]) -> str:
+        # Count nodes from the local watch cache, if it is up to date
+        if node_cache.is_fresh():
+            return str(len(node_cache.items))
+        # Count the nodes in the cluster (without fetching them)
+        return str(await count_items_raw(clients.core_v1_api.list_node))
+
+async def _read_selector(namespace: str, deployment_name: str):
+    """
+    Fetch a deployment's selector, as `(match_labels, label selector string)`, and cache it.
+    """
+    deployment = await clients.apps_v1_api.read_namespaced_deployment(deployment_name, namespace)
+    match_labels = deployment.spec.selector.match_labels or {}
+    selector = (match_labels, label_selector(match_labels))
+    _selector_cache[(namespace, deployment_name)] = _last_selectors[(namespace, deployment_name)] = selector
+    return selector
+
+async def _list_first_pod(namespace: str, selector_string: str):
+    return await clients.core_v1_api.list_namespaced_pod(namespace=namespace, label_selector=selector_string, limit=1)
 
 class DeploymentPodsHandler:
     """
     Handles queries that list pods created by a specific deployment.
     Requires `deployment_name` to be provided. Defaults to 'default' namespace if none is provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="short", watch_caches=(deployment_cache, pod_cache))
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         deployment_name = parameters.get('deployment_name') # Deployment name must be specified
         if not deployment_name:
             raise ValueError("Deployment name required")
         namespace = parameters.get('namespace', 'default')
         
-        # Fetch deployment details
-        deployment = apps_v1_api.read_namespaced_deployment(deployment_name, namespace)
-        # Extract label selectors for the deployment
-        selector = deployment.spec.selector.match_labels
-        # Convert selectors into a query string
-        label_selector = ','.join(f"{k}={v}" for k, v in selector.items())
-        
-        # Fetch pods matching the deployment
-        pods = core_v1_api.list_namespaced_pod(namespace=namespace, label_selector=label_selector)
+        # Look up the deployment's selector in the local watch cache
+        cached_selector = pods = None
+        if deployment_cache.is_fresh():
+            cached_selector = deployment_cache.items.get((namespace, deployment_name))
+        if cached_selector is None:
+            # Otherwise, reuse a recently fetched selector or fetch the deployment details
+            key = (namespace, deployment_name)
+            cached_selector = _selector_cache.get(key)
+            if cached_selector is None:
+                stale_selector = _last_selectors.get(key)
+                if stale_selector is not None and not pod_cache.is_fresh():
+                    # List pods with the last known selector while the deployment is read,
+                    # and keep the result if the selector hasn't changed
+                    pods_task = asyncio.create_task(_list_first_pod(namespace, stale_selector[1]))
+                    try:
+                        cached_selector = await _read_selector(namespace, deployment_name)
+                    finally:
+                        if cached_selector != stale_selector:
+                            pods_task.cancel()
+                            await asyncio.gather(pods_task, return_exceptions=True)
+                    if cached_selector == stale_selector:
+                        pods = await pods_task
+                else:
+                    cached_selector = await _read_selector(namespace, deployment_name)
+        selector, selector_string = cached_selector
+
+        # Match pods from the local watch cache, if it is up to date
+        if pod_cache.is_fresh():
+            pod_names = sorted(
+                name for (ns, name), labels in pod_cache.items.items()
+                if ns == namespace and selector.items() <= labels.items()
+            )
+            return simplify_name(pod_names[0]) if pod_names else ""
+
+        # Fetch the first pod matching the deployment (only one name is returned)
+        if pods is None:
+            pods = await _list_first_pod(namespace, selector_string)
         if not pods.items:
             return ""
         # Simplify the returning pod name
@@ -81,13 +234,15 @@ class ServicePortHandler:
     Handles queries that request the port number of a service.
     Requires `service_name` to be provided. Defaults to 'default' namespace if none is provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="long")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         service_name = parameters.get('service_name') # Service name must be specified
         if not service_name:
             raise ValueError("Service name required")
         namespace = parameters.get('namespace', 'default')
         
-        service = core_v1_api.read_namespaced_service(service_name, namespace) # Fetches service details
+        service = await clients.core_v1_api.read_namespaced_service(service_name, namespace) # Fetches service details
         if not service.spec.ports:
             return ""
         return str(service.spec.ports[0].port) # Returns the first port in the service spec
@@ -97,13 +252,15 @@ class DeploymentReplicasHandler:
     Handles queries that request the number of replicas in a deployment.
     Requires `deployment_name` to be provided. Defaults to 'default' namespace if none is provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="normal")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         deployment_name = parameters.get('deployment_name') # Deployment name must be specified
         if not deployment_name:
             raise ValueError("Deployment name required")
         namespace = parameters.get('namespace', 'default')
         
-        deployment = apps_v1_api.read_namespaced_deployment(deployment_name, namespace) # Fetches deployment details
+        deployment = await clients.apps_v1_api.read_namespaced_deployment(deployment_name, namespace) # Fetches deployment details
         return str(deployment.spec.replicas) # Returns the configured number of replicas
 
 class PodContainersHandler:
@@ -111,21 +268,22 @@ class PodContainersHandler:
     Handles queries that list the container names within a pod.
     Requires `pod_name` to be provided. Defaults to 'default' namespace if none is provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="normal")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         pod_name = parameters.get('pod_name') # Pod name must be specified
         if not pod_name:
             raise ValueError("Pod name required")
         namespace = parameters.get('namespace', 'default') # Default to 'default' namespace
         
         # Fetch the pod details
-        pod = core_v1_api.read_namespaced_pod(pod_name, namespace)
+        pod = await clients.core_v1_api.read_namespaced_pod(pod_name, namespace)
         
         # Extract container image names (without tag)
         containers = []
         for container in pod.spec.containers:
-            image = container.image.split(':')[0] # Remove tag if present
-            if '/' in image:
-                image = image.split('/')[-1] # Get just the image name without registry
+            image = container.image.rpartition('/')[2] # Get just the image name without registry
+            image = image.partition(':')[0].partition('@')[0] # Remove tag/digest if present
             containers.append(image)
         
         return ",".join(containers)
@@ -135,13 +293,15 @@ class ServiceTypeHandler:
     Handles queries that request the type of a service (e.g., ClusterIP, NodePort, LoadBalancer).
     Requires `service_name` to be provided. Defaults to 'default' namespace if none is provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="long")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         service_name = parameters.get('service_name') # Service name must be specified
         if not service_name:
             raise ValueError("Service name required")
         namespace = parameters.get('namespace', 'default')
         
-        service = core_v1_api.read_namespaced_service(service_name, namespace) # Fetches service details
+        service = await clients.core_v1_api.read_namespaced_service(service_name, namespace) # Fetches service details
         return service.spec.type # Returns the service type
 
 class PodNamespaceHandler:
@@ -149,24 +309,34 @@ class PodNamespaceHandler:
     Handles queries that request the namespace of a specific pod.
     Requires `pod_name` to be provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="normal")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         pod_name = parameters.get('pod_name') # Pod name must be specified
         if not pod_name:
             raise ValueError("Pod name required")
         
-        pods = core_v1_api.list_pod_for_all_namespaces() # Fetches all pods across all namespaces
-        for pod in pods.items:
-            if pod.metadata.name == pod_name:
-                return pod.metadata.namespace # Returns the namespace if the pod is found
+        # Let the API server filter pods by name (instead of fetching every pod in the cluster)
+        pods = await clients.core_v1_api.list_pod_for_all_namespaces(
+            field_selector=f"metadata.name={pod_name}",
+            limit=1
+        )
+        if pods.items:
+            return pods.items[0].metadata.namespace # Returns the namespace if the pod is found
         return "not found" # Pod is not present in any namespace
 
 class ListNamespacesHandler:
     """
     Handles queries that list all namespaces in the Kubernetes cluster.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
-        namespaces = core_v1_api.list_namespace() # Fetches all namespaces
-        namespace_names = [ns.metadata.name for ns in namespaces.items] # Extracts namespace names
+    __slots__ = ()
+    @cached(policy="long", watch_caches=(namespace_cache,))
+    async def handle(self, parameters: Dict[str, Any]) -> str:
+        if namespace_cache.is_fresh():
+            namespace_names = sorted(name for (_, name) in namespace_cache.items) # Reads names from the watch cache
+        else:
+            namespaces = await list_items_raw(clients.core_v1_api.list_namespace) # Fetches all namespaces (raw JSON)
+            namespace_names = [ns['metadata']['name'] for ns in namespaces] # Extracts namespace names
         return ",".join(namespace_names) # Returns the namespace names as a comma-separated string
 
 class NodeStatusHandler:
@@ -174,12 +344,14 @@ class NodeStatusHandler:
     Handles queries that request the status of a specific node.
     Requires `node_name` to be provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="normal")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         node_name = parameters.get('node_name') # Node name must be specified
         if not node_name:
             raise ValueError("Node name required")
         
-        node = core_v1_api.read_node(node_name) # Fetches node details
+        node = await clients.core_v1_api.read_node(node_name) # Fetches node details
         for condition in node.status.conditions:
             if condition.type == 'Ready': # Looks for the 'Ready' condition
                 return condition.status # Returns the status of the node (e.g., True, False)
@@ -190,34 +362,57 @@ class ListServicesHandler:
     Handles queries that list all services in a specified namespace.
     Defaults to 'default' namespace if none is provided.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="long", watch_caches=(service_cache,))
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         namespace = parameters.get('namespace', 'default') # Defaults to 'default' if no namespace provided
-        services = core_v1_api.list_namespaced_service(namespace) # Fetches all services in the namespace
-        service_names = [simplify_name(svc.metadata.name) for svc in services.items] # Extracts service names
+        if service_cache.is_fresh():
+            # Reads service names from the watch cache (sorted, like the API server's list order)
+            service_names = [simplify_name(name) for (ns, name) in sorted(service_cache.items) if ns == namespace]
+        else:
+            # Fetches all services in the namespace (raw JSON)
+            services = await list_items_raw(clients.core_v1_api.list_namespaced_service, namespace=namespace)
+            service_names = [simplify_name(svc['metadata']['name']) for svc in services] # Extracts service names
         return ",".join(service_names) # Returns the service names as a comma-separated string
 
 class PodLogsHandler:
     """
     Handles queries that request the recent logs of a specific pod.
     Requires `pod_name` to be provided. Defaults to 'default' namespace if none is provided.
-    Limits the logs to the last 10 lines by default.
+    Limits the logs to the last 10 lines (and at most `MAX_LOG_BYTES`) by default.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="short")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         pod_name = parameters.get('pod_name') # Pod name must be specified
         if not pod_name:
             raise ValueError("Pod name required")
         namespace = parameters.get('namespace', 'default') # Default to 'default' namespace
         
         try:
-            # Fetch the last 10 lines of the pod's logs
-            logs = core_v1_api.read_namespaced_pod_log(
+            # Stream the last 10 lines of the pod's logs (instead of buffering the whole response)
+            response = await clients.core_v1_api.read_namespaced_pod_log(
                 pod_name, 
                 namespace,
-                tail_lines=10 # Limit to the last 10 lines of logs
+                tail_lines=10, # Limit to the last 10 lines of logs
+                limit_bytes=MAX_LOG_BYTES, # Limit the response size on the server side
+                _preload_content=False
             )
+            raise_for_status(response)
+            try:
+                # Read at most `MAX_LOG_BYTES`, then stop reading
+                data = b""
+                while len(data) < MAX_LOG_BYTES:
+                    chunk = await response.content.read(MAX_LOG_BYTES - len(data))
+                    if not chunk:
+                        break
+                    data += chunk
+            finally:
+                response.release()
+            logs = data.decode('utf-8', errors='replace')
             return logs.strip() # Return the logs (stripped of leading/trailing whitespace)
         except Exception as e:
-            logging.error(f"Error getting pod logs: {e}") # Log any errors encountered
+            logging.error("Error getting pod logs: %s", e) # Log any errors encountered
             return "No logs available" # Return a fallback message if logs can't be retrieved
 
 class ResourceUsageHandler:
@@ -226,14 +421,16 @@ class ResourceUsageHandler:
     Requires `pod_name` to be provided. Defaults to 'default' namespace if none is provided.
     Returns the CPU and memory requests for the pod's first container.
     """
-    def handle(self, parameters: Dict[str, Any]) -> str:
+    __slots__ = ()
+    @cached(policy="normal")
+    async def handle(self, parameters: Dict[str, Any]) -> str:
         pod_name = parameters.get('pod_name') # Pod name must be specified
         if not pod_name:
             raise ValueError("Pod name required")
         namespace = parameters.get('namespace', 'default') # Default to 'default' namespace
         
         # Fetch the pod details
-        pod = core_v1_api.read_namespaced_pod(pod_name, namespace)
+        pod = await clients.core_v1_api.read_namespaced_pod(pod_name, namespace)
         # Get resource requests for the first container in the pod
         resources = pod.spec.containers[0].resources
         if resources and resources.requests:
@@ -244,8 +441,8 @@ class ResourceUsageHandler:
         return "No resource requests specified" # Fallback message if no resources are specified
 
 # Query handler registry:
-# (maps query types to their corresponding handler classes for easy extensibility)
-QUERY_HANDLERS = {
+# (maps query types to their corresponding handler classes for easy extensibility; read-only once built)
+QUERY_HANDLERS = MappingProxyType({
     "count_pods": CountPodsHandler(),
     "pod_status": PodStatusHandler(),
     "count_nodes": CountNodesHandler(),
@@ -260,4 +457,4 @@ QUERY_HANDLERS = {
     "list_services": ListServicesHandler(),
     "pod_logs": PodLogsHandler(),
     "resource_usage": ResourceUsageHandler(),
-}
+})
@@ -2,7 +2,21 @@
 This file defines common functions used across multiple modules.
 """
 
+import re
+from functools import lru_cache
+from typing import Any, Dict, List
+import orjson
+from kubernetes_asyncio import client
+
+# Page size for (raw) list requests
+LIST_PAGE_SIZE = 500
+
+# Hash-like name segment: 5-10 characters (between hyphens) containing at least one digit
+_HASH_SEGMENT_RE = re.compile(r'(?:^|-)(?=[^-]*\d)[^-]{5,10}(?=-|$)')
+
 # Helper function to simplify Kubernetes resource names:
+# (memoized, since pods from the same deployment share their name prefix and are listed repeatedly)
+@lru_cache(maxsize=4096)
 def simplify_name(full_name: str) -> str:
     """
     Simplifies a Kubernetes resource name by removing hash-like suffixes.
@@ -24,23 +38,66 @@ def simplify_name(full_name: str) -> str:
         - 'mongodb-56c598c8fc' -> 'mongodb'
         - 'my-deployment-577d9fbfb9-z8246' -> 'my-deployment'
     """
-    # Constants defining typical hash suffix lengths
-    MIN_HASH_LENGTH = 5
-    MAX_HASH_LENGTH = 10
-    
-    # Split resource name into parts (using hyphens as delimiter)
-    parts = full_name.split('-')
-    simplified = []
-
-    for part in parts:
-        # Stop if the part matches hash pattern (5-10 chars, contains digit)
-        is_hash = (MIN_HASH_LENGTH <= len(part) <= MAX_HASH_LENGTH and 
-                  any(char.isdigit() for char in part))
-        
-        if is_hash:
-            break
-    
-        simplified.append(part)
+    # Cut the name at the first hash-like segment (single pass of the C regex engine)
+    match = _HASH_SEGMENT_RE.search(full_name)
+    if match:
+        return full_name[:match.start()]
+    return full_name
+
+# Raw (not deserialized) Kubernetes API responses:
+def raise_for_status(response) -> None:
+    """
+    Raise an `ApiException` for an error `response`.
+    The client does not check the status itself when called with `_preload_content=False`.
+    """
+    if not 200 <= response.status <= 299:
+        response.release()
+        raise client.rest.ApiException(status=response.status, reason=response.reason)
 
-    # Join the valid (non-hash) segments for the simplified name
-    return '-'.join(simplified)
+async def list_page_raw(list_func, limit: int, continue_token=None, **kwargs) -> Dict[str, Any]:
+    """
+    Fetch one page (up to `limit` items) of a Kubernetes list call as a plain dict.
+    Only the JSON is parsed (with orjson), skipping the client's model deserialization.
+    """
+    response = await list_func(
+        limit=limit,
+        _continue=continue_token,
+        _preload_content=False,
+        **kwargs
+    )
+    raise_for_status(response)
+    try:
+        return orjson.loads(await response.read())
+    finally:
+        response.release()
+
+async def list_items_raw(list_func, **kwargs) -> List[Dict[str, Any]]:
+    """
+    Fetch all items of a Kubernetes list call as plain dicts, `LIST_PAGE_SIZE` items at a time.
+    """
+    items = []
+    continue_token = None
+    while True:
+        data = await list_page_raw(list_func, LIST_PAGE_SIZE, continue_token, **kwargs)
+        items.extend(data['items'])
+        continue_token = data['metadata'].get('continue')
+        if not continue_token:
+            return items
+
+async def count_items_raw(list_func, **kwargs) -> int:
+    """
+    Count the items of a Kubernetes list call without transferring them.
+    Requests a single item and uses the server's `remainingItemCount`, falling back to
+    counting page by page when the server doesn't provide it (e.g., with selectors).
+    """
+    data = await list_page_raw(list_func, 1, **kwargs)
+    count = len(data['items'])
+    continue_token = data['metadata'].get('continue')
+    remaining = data['metadata'].get('remainingItemCount')
+    if remaining is not None:
+        return count + remaining
+    while continue_token:
+        data = await list_page_raw(list_func, LIST_PAGE_SIZE, continue_token, **kwargs)
+        count += len(data['items'])
+        continue_token = data['metadata'].get('continue')
+    return count
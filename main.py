@@ -7,25 +7,70 @@ deployed on a Kubernetes cluster.
 This script implements the core API endpoint and service structure.
 """
 
+import atexit
 import logging
+import os
+import queue
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
 from pydantic import BaseModel, ValidationError
-from clients import verify_clients
+from clients import init_clients, close_clients, verify_clients, warm_up_clients
+from cache import start_caches, stop_caches
 from handlers import QUERY_HANDLERS
-from utils import classify_query, get_kubernetes_info
+from utils import classify_query, get_kubernetes_info, classification_batcher, load_encoding, load_semantic_cache, save_semantic_cache
 
 # Logging configuration:
-# - DEBUG level captures more detailed information
-# - filemode='a' ensures logs are appended, not overwritten
+# - LOG_LEVEL defaults to INFO (set LOG_LEVEL=DEBUG to capture more detailed information)
+# - Records are put on a queue and written to disk by a background listener thread,
+#   so request handling never waits on file I/O
+# - All worker processes append to the same log file, so it is not rotated in-process (workers would
+#   race to rename it); rotate it externally (e.g., with logrotate), and it is reopened when moved
+log_queue = queue.Queue(-1)
+file_handler = WatchedFileHandler('agent.log', mode='a')
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s')) # Final formatting is done by `file_handler`
 logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s - %(message)s',
-    filename='agent.log',
-    filemode='a'
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    handlers=[queue_handler],
+    force=True # Replace the default handler installed by log calls made while importing `clients`
 )
+log_listener.start()
+atexit.register(log_listener.stop) # Flush remaining records on exit
+
+# Application lifespan:
+# - Initialize and verify clients, warm up connections and start background tasks before serving requests
+# - Stop background tasks and close the API clients on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_clients()
+    try:
+        verify_clients()
+    except Exception as e:
+        logging.error("Failed to verify clients: %s", e)
+        raise SystemExit("Failed to verify required clients.")
+    # Open API connections before the first query arrives
+    await warm_up_clients()
+    # Start watching Kubernetes resources in the background
+    start_caches()
+    # Start batching concurrent AI classifications
+    classification_batcher.start()
+    await load_encoding()
+    await load_semantic_cache()
+    try:
+        yield
+    finally:
+        await classification_batcher.stop()
+        await save_semantic_cache()
+        await stop_caches()
+        await close_clients()
 
 # Initialize FastAPI app (for automatic data validation compared to Flask)
-app = FastAPI()
+# (responses with a `response_model` are serialized directly to JSON bytes by Pydantic)
+app = FastAPI(lifespan=lifespan)
 
 # Define question (query), answer (response) structure
 # (Pydantic BaseModel -- automatic data validation)
@@ -36,56 +81,52 @@ class QueryResponse(BaseModel):
     query: str
     answer: str
 
-# Verify clients before serving requests
-try:
-    verify_clients()
-    logging.debug("All clients successfully verified.")
-except Exception as e:
-    logging.error(f"Failed to verify clients: {e}")
-    raise SystemExit("Failed to verify required clients.")
-
 # Health check endpoint: verify FastAPI is running
+# (the response body is static, so it is serialized once)
+_HEALTH_BODY = b'{"status":"healthy"}'
+
 @app.get("/health")
-def health_check():
-    return {"status": "healthy"}
+async def health_check():
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 # API (POST) endpoint (to process queries, return responses):
 #   (includes validation and error handling for both request and response)
 @app.post("/query", response_model=QueryResponse)
-def process_query(request: QueryRequest):
+async def process_query(request: QueryRequest):
     """
     Handle incoming queries (`request`) and return responses.
     Returns only the answer without additional context.
     """
     try:
         # Log incoming query
-        logging.debug(f"Processing query: {request.query}")
+        logging.debug("Processing query: %s", request.query)
 
         # Classify query using GPT-4o-mini
-        classification = classify_query(request.query)
+        classification = await classify_query(request.query)
 
         # Get info. from Kubernetes
-        answer = get_kubernetes_info(
+        answer = await get_kubernetes_info(
             classification['type'],
             classification.get('parameters', {})
         )
 
         # Log the response
-        logging.debug(f"Query response: {answer}")
+        logging.debug("Query response: %s", answer)
 
         # Return using the specified response model/format
-        return QueryResponse(query=request.query, answer=answer)
+        # (both fields are already valid strings, so skip validating them again)
+        return QueryResponse.model_construct(query=request.query, answer=answer)
     except ValidationError as e:
         # Handle validation errors
-        logging.error(f"Validation error: {e}")
+        logging.error("Validation error: %s", e)
         raise HTTPException(status_code=400, detail=e.errors())
     except ValueError as e:
         # Handle invalid queries
-        logging.error(f"Invalid query: {e}")
+        logging.error("Invalid query: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         # General error handling
-        logging.error(f"Error processing query: {e}")
+        logging.error("Error processing query: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
     
 # Main entry point
@@ -95,7 +136,7 @@ if __name__ == "__main__":
     
     # Configure logging
     logging.debug("Initializing Query Agent")
-    logging.debug(f"Registered handlers: {', '.join(QUERY_HANDLERS.keys())}")
+    logging.debug("Registered handlers: %s", ', '.join(QUERY_HANDLERS.keys()))
     
     # Get port from command line args or use default
     port = 8000
@@ -103,17 +144,28 @@ if __name__ == "__main__":
         try:
             port = int(sys.argv[1])
         except ValueError:
-            logging.error(f"Invalid port number: {sys.argv[1]}")
+            logging.error("Invalid port number: %s", sys.argv[1])
             sys.exit(1)
     
+    workers = int(os.getenv('WORKERS', os.cpu_count() or 4))
+    os.environ['WORKERS'] = str(workers) # Inherited by the worker processes
+
     # Start server
+    # - One worker process per CPU core by default (override with WORKERS); each worker
+    #   has its own clients and watch caches, while the response cache is shared via Redis
+    # - WORKERS is exported so that each worker takes its share of the OpenAI rate limits
+    # - "auto" selects uvloop and httptools (installed with uvicorn[standard]) when available
     try:
         uvicorn.run(
-            "main:app", # Use string reference to app
-            host="127.0.0.1",
+            "main:app", # Use string reference to app (required for multiple workers)
+            host=os.getenv('HOST', '127.0.0.1'),
             port=port,
-            log_level="info"
+            workers=workers,
+            loop="auto",
+            http="auto",
+            log_level="warning",
+            access_log=False # Skip per-request access log records entirely
         )
     except Exception as e:
-        logging.error(f"Failed to start server: {e}")
+        logging.error("Failed to start server: %s", e)
         sys.exit(1)
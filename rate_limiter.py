@@ -0,0 +1,51 @@
+"""
+This file defines a client-side rate limiter for OpenAI API calls.
+
+Requests wait until both the requests-per-minute (RPM) and tokens-per-minute (TPM) budgets
+have capacity, so bursts of queries are spread out instead of being rejected with 429 errors.
+"""
+
+import asyncio
+import time
+
+class RateLimiter:
+    """
+    Token bucket limiter for `requests_per_minute` requests and `tokens_per_minute` tokens.
+    Both buckets start full and refill continuously; waiting requests are served in order.
+    """
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._updated_at) / 60
+        self._updated_at = now
+        self._available_requests = min(
+            self.requests_per_minute, self._available_requests + elapsed_minutes * self.requests_per_minute
+        )
+        self._available_tokens = min(
+            self.tokens_per_minute, self._available_tokens + elapsed_minutes * self.tokens_per_minute
+        )
+
+    async def acquire(self, tokens: int):
+        """
+        Wait until one request using (an estimated) `tokens` tokens can be made, and reserve it.
+        """
+        tokens = min(tokens, self.tokens_per_minute) # A request can never use more than the whole budget
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._available_requests >= 1 and self._available_tokens >= tokens:
+                    self._available_requests -= 1
+                    self._available_tokens -= tokens
+                    return
+                # Sleep until both buckets have refilled enough
+                await asyncio.sleep(max(
+                    (1 - self._available_requests) * 60 / self.requests_per_minute,
+                    (tokens - self._available_tokens) * 60 / self.tokens_per_minute
+                ))
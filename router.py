@@ -0,0 +1,136 @@
+"""
+This file defines a local, rule-based query router.
+
+Common, unambiguous queries are classified with precompiled regular expressions so that
+they can skip the (much slower) AI classification step. A rule only applies if it matches
+the whole query; anything else is left to GPT-4o-mini.
+
+The rules cover all 14 query types in place of a local ML intent classifier (e.g., a fine-tuned,
+int8-quantized ONNX model with a slot tagger): such a model would need training data, model files
+and an ML runtime that this project doesn't ship, while compiled rules classify common phrasings
+just as locally, in microseconds, and never guess a parameter that isn't in the query.
+"""
+
+import re
+from typing import Optional
+
+# Kubernetes resource name (optionally quoted); "the" and "my" are never names, so, e.g.,
+# "how many pods are running in the namespace" is left to the AI model
+_NAME = r"""(?!(?:the|my)\b)['"]?(?P<{group}>[a-z0-9](?:[-a-z0-9.]*[a-z0-9])?)['"]?"""
+# Optional "in the <namespace> namespace" clause
+_NAMESPACE = r"(?: in (?:the )?" + _NAME.format(group="namespace") + r" namespace)?"
+
+# Local classification rules: (pattern, query type, parameters the pattern extracts)
+_RULES = [
+    (
+        r"how many pods(?: are)?(?: there)?(?: running)?" + _NAMESPACE,
+        "count_pods",
+        ("namespace",)
+    ),
+    (
+        r"(?:what(?: is|'s) )?(?:the )?status of (?:the )?pod(?: named| called)? "
+        + _NAME.format(group="pod_name") + _NAMESPACE,
+        "pod_status",
+        ("pod_name", "namespace")
+    ),
+    (
+        r"how many nodes(?: are)?(?: there)?(?: in (?:the|my) cluster)?",
+        "count_nodes",
+        ()
+    ),
+    (
+        r"(?:(?:which|what) pods? (?:is |are )?|(?:list|show)(?: the)? pods? )"
+        r"(?:(?:spawned|created|managed) by|from) (?:the )?(?:deployment )?"
+        + _NAME.format(group="deployment_name") + r"(?: deployment)?" + _NAMESPACE,
+        "deployment_pods",
+        ("deployment_name", "namespace")
+    ),
+    (
+        r"(?:list|show|what are) (?:all )?(?:the )?namespaces(?: in (?:the|my) cluster)?",
+        "list_namespaces",
+        ()
+    ),
+    (
+        r"(?:(?:what(?: is|'s) )?(?:the )?port (?:of|for|used by) (?:the )?service(?: named| called)? "
+        r"|(?:what|which) port does (?:the )?(?:service )?)"
+        + _NAME.format(group="service_name") + r"(?: service)?(?: use| expose| listen on)?" + _NAMESPACE,
+        "service_port",
+        ("service_name", "namespace")
+    ),
+    (
+        r"how many replicas (?:does|are there (?:in|for)|in|for) (?:the )?(?:deployment )?"
+        + _NAME.format(group="deployment_name") + r"(?: deployment)?(?: have)?" + _NAMESPACE,
+        "deployment_replicas",
+        ("deployment_name", "namespace")
+    ),
+    (
+        r"(?:(?:what|which) containers (?:are )?|(?:list|show)(?: the)? containers )(?:in|of|running in) "
+        r"(?:the )?pod(?: named| called)? " + _NAME.format(group="pod_name") + _NAMESPACE,
+        "pod_containers",
+        ("pod_name", "namespace")
+    ),
+    (
+        r"(?:what(?: is|'s) )?(?:the )?type of (?:the )?service(?: named| called)? "
+        + _NAME.format(group="service_name") + _NAMESPACE,
+        "service_type",
+        ("service_name", "namespace")
+    ),
+    (
+        r"(?:what|which) namespace is (?:the )?pod(?: named| called)? " + _NAME.format(group="pod_name") + r"(?: running)?(?: in)?",
+        "pod_namespace",
+        ("pod_name",)
+    ),
+    (
+        r"(?:what(?: is|'s) )?(?:the )?status of (?:the )?node(?: named| called)? " + _NAME.format(group="node_name"),
+        "node_status",
+        ("node_name",)
+    ),
+    (
+        r"(?:list|show|what are) (?:all )?(?:the )?services" + _NAMESPACE,
+        "list_services",
+        ("namespace",)
+    ),
+    (
+        r"(?:(?:show|get)(?: me)? |what are )?(?:the )?(?:recent |latest )?logs (?:of|for|from) "
+        r"(?:the )?pod(?: named| called)? " + _NAME.format(group="pod_name") + _NAMESPACE,
+        "pod_logs",
+        ("pod_name", "namespace")
+    ),
+    (
+        r"(?:what(?: is|'s| are) )?(?:the )?resource (?:usage|requests) (?:of|for) "
+        r"(?:the )?pod(?: named| called)? " + _NAME.format(group="pod_name") + _NAMESPACE,
+        "resource_usage",
+        ("pod_name", "namespace")
+    ),
+]
+
+# All rules combined into a single pattern, so one match attempt checks every rule:
+# each rule is wrapped in a `rule<i>` group, and its parameter groups are prefixed with `r<i>_`
+# (the wrapper group closes last, so `match.lastgroup` identifies the matching rule)
+_COMBINED = re.compile(
+    "|".join(
+        f"(?P<rule{i}>" + re.sub(r"\(\?P<(\w+)>", f"(?P<r{i}_\\1>", pattern) + ")"
+        for i, (pattern, _, _) in enumerate(_RULES)
+    ),
+    re.I
+)
+
+def classify_local(query: str) -> Optional[dict]:
+    """
+    Classify `query` using the local rules.
+    Returns the same structure as `classify_query`, or None if no rule matches the whole query.
+    """
+    # Normalize whitespace and trailing punctuation
+    normalized = " ".join(query.split()).rstrip("?.! ")
+
+    match = _COMBINED.fullmatch(normalized)
+    if not match:
+        return None
+
+    i = int(match.lastgroup[len("rule"):])
+    _, query_type, parameter_names = _RULES[i]
+    parameters = {name: match.group(f"r{i}_{name}") for name in parameter_names if match.group(f"r{i}_{name}")}
+    # Same default as the AI classifier: use "default" namespace if none specified
+    if "namespace" in parameter_names:
+        parameters.setdefault("namespace", "default")
+    return {"type": query_type, "parameters": parameters}
@@ -0,0 +1,103 @@
+"""
+This file defines a semantic (embedding-based) cache for AI query classification.
+
+Queries that are worded differently but mean the same thing (e.g., "How many pods are in
+the default namespace?" and "Count the pods in the default namespace") have similar
+embeddings, so a previous classification can be reused instead of calling GPT-4o-mini.
+"""
+
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+import numpy as np
+import orjson
+
+class SemanticCache:
+    """
+    Keeps up to `max_entries` (normalized) query embeddings with their classifications,
+    and returns the classification of the most similar previous query if its cosine
+    similarity is at least `threshold`. When full, the oldest entries are replaced first.
+    """
+    def __init__(self, threshold: float = 0.92, max_entries: int = 2000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._vectors: Optional[np.ndarray] = None # (max_entries, dimensions), allocated on first use
+        self._entries: List[Optional[Tuple[str, dict]]] = [None] * max_entries # (query, classification)
+        self._size = 0
+        self._next = 0 # Next slot to fill
+
+    def __len__(self) -> int:
+        return self._size
+
+    def lookup(self, embedding: List[float], query: str) -> Optional[dict]:
+        """
+        Return the classification of the most similar cached query, or None.
+        A match is only used if all of its parameter values also appear in `query` as whole names,
+        so that, e.g., a query about pod "web-2" doesn't reuse the classification for pod "web".
+        """
+        if not self._size:
+            return None
+        scores = self._vectors[:self._size] @ _normalize(embedding)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        cached_query, result = self._entries[best]
+        lowered = query.lower()
+        if not all(_contains_name(lowered, str(value).lower()) for value in result.get("parameters", {}).values()):
+            return None
+        logging.debug("Semantic cache match (%.3f): %s", scores[best], cached_query)
+        return result
+
+    def add(self, embedding: List[float], query: str, result: dict):
+        """
+        Store the classification `result` for `query`.
+        """
+        vector = _normalize(embedding)
+        if self._vectors is None:
+            self._vectors = np.empty((self.max_entries, vector.shape[0]), dtype=np.float32)
+        self._vectors[self._next] = vector
+        self._entries[self._next] = (query, result)
+        self._next = (self._next + 1) % self.max_entries
+        self._size = min(self._size + 1, self.max_entries)
+
+    def save(self, path: str):
+        """
+        Write the cached embeddings and classifications to `path` (an `.npz` file).
+        """
+        if not self._size:
+            return
+        # Oldest entries first, so the newest are kept when loading into a smaller cache
+        start = (self._next - self._size) % self.max_entries
+        order = [(start + i) % self.max_entries for i in range(self._size)]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                vectors=self._vectors[order],
+                entries=np.frombuffer(orjson.dumps([self._entries[i] for i in order]), dtype=np.uint8)
+            )
+        os.replace(tmp_path, path) # Replace atomically (several worker processes may save)
+
+    def load(self, path: str):
+        """
+        Add the embeddings and classifications saved in `path`, if it exists.
+        """
+        if not os.path.exists(path):
+            return
+        with np.load(path) as data:
+            vectors = data["vectors"]
+            entries = orjson.loads(data["entries"].tobytes())
+        for vector, (query, result) in zip(vectors[-self.max_entries:], entries[-self.max_entries:]):
+            self.add(vector, query, result)
+        logging.debug("Loaded %s semantic cache entries", len(self))
+
+def _contains_name(text: str, name: str) -> bool:
+    # `name` must not be part of a longer (Kubernetes) name, e.g., "web" in "web-2" (a trailing period
+    # is only part of the name if more of the name follows it)
+    return re.search(rf"(?<![\w.-]){re.escape(name)}(?![\w-]|\.[\w-])", text) is not None
+
+def _normalize(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)